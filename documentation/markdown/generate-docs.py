@@ -16,44 +16,63 @@
 #
 
 import sys, os, glob
+from multiprocessing import Pool
 from markdown2 import markdown
 from jinja2 import Environment, FileSystemLoader
 
+# Parse a document, returning a tuple of (output name, title, HTML content), or
+# None if the document should be skipped.
+def parse_document(doc):
+    # Assume that the first line is the title, and that there are two lines
+    # after it before the actual content. Skip any document that does not
+    # have a H1 at the start.
+    f = open(doc, 'r')
+    title = f.readline().strip()
+    underline = f.readline().strip()
+    if len(title) != len(underline) or underline[0] != '=':
+        f.close()
+        return None
+    f.readline()
+
+    # Parse the document.
+    html = markdown(f.read()).encode(sys.stdout.encoding or "utf-8", 'xmlcharrefreplace')
+    f.close()
+
+    # Work out the output file name.
+    name = os.path.splitext(os.path.basename(doc))[0] + '.html'
+
+    return (name, title, html)
+
 def main():
     if len(sys.argv) != 3:
         print "Usage: %s <docs dir> <output dir>" % (sys.argv[0])
         return 1
 
-    # Get a list of documents and parse their content.
-    documents = []
-    for doc in glob.glob(os.path.join(sys.argv[1], '*.txt')):
-        # Assume that the first line is the title, and that there are two lines
-        # after it before the actual content. Skip any document that does not
-        # have a H1 at the start.
-        f = open(doc, 'r')
-        title = f.readline().strip()
-        underline = f.readline().strip()
-        if len(title) != len(underline) or underline[0] != '=':
-            continue
-        f.readline()
-
-        # Parse the document.
-        html = markdown(f.read()).encode(sys.stdout.encoding or "utf-8", 'xmlcharrefreplace')
-        f.close()
-
-        # Work out the output file name.
-        name = os.path.splitext(os.path.basename(doc))[0] + '.html'
-
-        # Add it to the list.
-        documents.append((name, title, html))
+    # Get a list of documents and parse their content. Documents are
+    # independent of each other so they are converted in parallel.
+    pool = Pool()
+    try:
+        documents = pool.map(parse_document, glob.glob(os.path.join(sys.argv[1], '*.txt')))
+    finally:
+        pool.close()
+        pool.join()
+    documents = [doc for doc in documents if doc]
 
     # Create the template loader.
-    tpl = Environment(loader=FileSystemLoader(os.path.join(sys.argv[1], 'markdown'))).get_template('template.html')
+    loader = Environment(loader=FileSystemLoader(os.path.join(sys.argv[1], 'markdown')))
+    tpl = loader.get_template('template.html')
+
+    # Render the sidebar entries for each document once up front. Each page's
+    # sidebar is then just a join of these, with the page's own entry shown
+    # as the current one.
+    sidebar = loader.get_template('sidebar.html').module
+    links = [(doc[0], sidebar.link(doc[0], doc[1]), sidebar.current(doc[1])) for doc in documents]
 
     # For each document, write the template.
     for doc in documents:
+        entries = ''.join([current if name == doc[0] else link for (name, link, current) in links])
         f = open(os.path.join(sys.argv[2], doc[0]), 'w')
-        f.write(tpl.render(name=doc[0], title=doc[1], content=doc[2], docs=documents))
+        f.write(tpl.render(name=doc[0], title=doc[1], content=doc[2], sidebar=entries))
         f.close()
 
 if __name__ == '__main__':
@@ -16,50 +16,128 @@
 #
 
 import sys
+from collections import Counter
+
+# intern() moved into the sys module in Python 3.
+intern = getattr(sys, 'intern', None) or __builtins__.intern
+
+# Caches used internally by the slab allocator, excluded unless --include-slab
+# is specified.
+slab_caches = frozenset(['slab_bufctl_cache', 'slab_mag_cache', 'slab_slab_cache'])
 
 def usage():
-    sys.stderr.write('Usage: %s [--include-slab] <log file>\n' % (sys.argv[0]))
+    sys.stderr.write('Usage: %s [--include-slab] [--totals] <log file>\n' % (sys.argv[0]))
     sys.exit(1)
 
-i = 1
 include_slab = False
-if len(sys.argv) == 2:
-    if sys.argv[1][0:2] == '--':
-        usage()
-elif len(sys.argv) == 3:
-    if sys.argv[1] == '--include-slab':
+totals = False
+args = sys.argv[1:]
+while len(args) != 0 and args[0][0:2] == '--':
+    arg = args.pop(0)
+    if arg == '--include-slab':
         include_slab = True
+    elif arg == '--totals':
+        totals = True
     else:
         usage()
-    i = 2
-else:
+if len(args) != 1:
     usage()
 
+# Parse a log line, returning None if it is not a slab event. Most lines in a
+# log are not, so check the prefix before doing any splitting.
+def parse_line(line):
+    if not line.startswith('slab: '):
+        return None
+    line = line.rstrip().split(' ', 6)
+    if len(line) != 7:
+        return None
+    return line
+
+# Check whether a file can be read a second time.
+def seekable(f):
+    try:
+        f.seek(0, 1)
+        return True
+    except (IOError, OSError):
+        return False
+
+# Collect the outstanding allocations by address. Each entry is a (cache,
+# caller) tuple so that the totals can be computed by counting the values
+# directly. The same cache and caller strings repeat many times, so they are
+# interned to share a single copy of each.
 allocations = {}
-f = open(sys.argv[i], 'r')
-for line in f.readlines():
-    line = line.strip().split(' ', 6)
-    if len(line) != 7 or line[0] != 'slab:':
-        continue
-
-    if line[1] == 'allocated':
-        allocations[line[2]] = [line[4], line[6]]
-    elif line[1] == 'freed':
-        try:
-            del allocations[line[2]]
-        except KeyError:
-            pass
-
-addr_width = 0
-name_width = 0
-for (k, v) in allocations.items():
-    addr_width = max(addr_width, len(k))
-    name_width = max(name_width, len(v[0]))
-
-print "%s %s Caller" % ("Address".ljust(addr_width), "Cache".ljust(name_width))
-print "%s %s ======" % ("=======".ljust(addr_width), "=====".ljust(name_width))
-
-for (k, v) in allocations.items():
-    slab_caches = ['slab_bufctl_cache', 'slab_mag_cache', 'slab_slab_cache']
-    if include_slab or v[0] not in slab_caches:
-        print "%s %s %s" % (k.ljust(addr_width), v[0].ljust(name_width), v[1])
+with open(args[0], 'r', 1 << 20) as f:
+    if seekable(f):
+        # Most allocations in a log are freed again. Rather than inserting
+        # every allocation into the dictionary only to remove it later, first
+        # find the position of the last free of each address. Addresses are
+        # reused, so an allocation is outstanding if it comes after the last
+        # free of its address.
+        last_free = {}
+        for (n, line) in enumerate(f):
+            line = parse_line(line)
+            if line and line[1] == 'freed':
+                last_free[line[2]] = n
+
+        f.seek(0)
+        for (n, line) in enumerate(f):
+            line = parse_line(line)
+            if line and line[1] == 'allocated' and last_free.get(line[2], -1) < n:
+                allocations[line[2]] = (intern(line[4]), intern(line[6]))
+        del last_free
+    else:
+        # The log can only be read once (e.g. it is a pipe), so track
+        # allocations as they are made and freed.
+        for line in f:
+            line = parse_line(line)
+            if not line:
+                continue
+            if line[1] == 'allocated':
+                allocations[line[2]] = (intern(line[4]), intern(line[6]))
+            elif line[1] == 'freed':
+                allocations.pop(line[2], None)
+
+# Output is collected into a list and written in one go, as there may be a
+# very large number of rows.
+out = []
+append = out.append
+
+if totals:
+    # Count outstanding allocations per (cache, caller), filtering as we go so
+    # only one pass is made over the outstanding allocations. Widths are then
+    # worked out from the distinct entries.
+    counts = Counter([v for v in allocations.values() if include_slab or v[0] not in slab_caches])
+
+    name_width = 0
+    for (cache, caller) in counts:
+        name_width = max(name_width, len(cache))
+
+    # Pad each distinct cache name once rather than on every row.
+    pad_name = {c: c.ljust(name_width) for (c, _) in counts}
+
+    append("%s %s Caller" % ("Count".ljust(8), "Cache".ljust(name_width)))
+    append("%s %s ======" % ("=====".ljust(8), "=====".ljust(name_width)))
+
+    for ((cache, caller), count) in counts.most_common():
+        append("%-8d %s %s" % (count, pad_name[cache], caller))
+else:
+    # Gather the rows to output and the column widths in a single pass.
+    rows = []
+    addr_width = 0
+    name_width = 0
+    for (k, v) in allocations.items():
+        if include_slab or v[0] not in slab_caches:
+            rows.append((k, v))
+            addr_width = max(addr_width, len(k))
+            name_width = max(name_width, len(v[0]))
+
+    pad_name = {v[0]: v[0].ljust(name_width) for (k, v) in rows}
+
+    append("%s %s Caller" % ("Address".ljust(addr_width), "Cache".ljust(name_width)))
+    append("%s %s ======" % ("=======".ljust(addr_width), "=====".ljust(name_width)))
+
+    for (k, v) in rows:
+        append("%s %s %s" % (k.ljust(addr_width), pad_name[v[0]], v[1]))
+
+sys.stdout.write('\n'.join(out))
+sys.stdout.write('\n')
@@ -17,6 +17,8 @@
 
 import sys
 
+hex_table = ['0x%02x, ' % (i) for i in range(256)]
+
 def usage():
     sys.stderr.write('Usage: %s [ARGS...] <binary> <variable name>\n' % (sys.argv[0]))
     sys.stderr.write('Possible arguments:\n')
@@ -64,16 +66,13 @@ def main(args):
         sys.stdout.write('#endif\n')
     else:
         sys.stdout.write('unsigned char %s[] = {\n' % (args[1]))
-    for i in range(0, len(data)):
-        if not i % 8:
-            if i > 0:
-                sys.stdout.write('\n')
-            sys.stdout.write('\t')
-        # Ugh, Python 3.
-        if sys.version < '3':
-            sys.stdout.write('0x%02x, ' % (ord(data[i])))
-        else:
-            sys.stdout.write('0x%02x, ' % (data[i]))
+    # Format the data 8 bytes per line using a lookup table. bytearray gives
+    # integers when iterated on both Python 2 and 3.
+    data = bytearray(data)
+    lines = []
+    for i in range(0, len(data), 8):
+        lines.append('\t' + ''.join([hex_table[b] for b in data[i:i + 8]]))
+    sys.stdout.write('\n'.join(lines))
     sys.stdout.write('\n};\n')
     if size:
         sys.stdout.write('\nunsigned int %s_size = %d;\n' % (args[1], len(data)))
@@ -15,16 +15,36 @@
 #
 
 from SCons.Script import *
-import os
-
-# Builder to pre-process a linker script
+import os, subprocess
+
+# Builder to pre-process a linker script. The preprocessor output is filtered
+# here rather than by piping through grep in a shell.
+def ld_script_func(target, source, env):
+    cmd = env.subst_list('$CC $_CCCOMCOM $ASFLAGS -E -x c $SOURCE', target = target, source = source)[0]
+    cmd = [str(arg) for arg in cmd]
+
+    proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, env = env['ENV'])
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        return proc.returncode
+
+    with open(str(target[0]), 'wb') as f:
+        f.writelines([line for line in output.splitlines(True) if not line.startswith(b'#')])
+
+    return 0
+def ld_script_str(target, source, env):
+    # Show the preprocessor command line in verbose builds.
+    comstr = env.subst('$GENCOMSTR', target = target, source = source)
+    if comstr:
+        return comstr
+    return env.subst('$CC $_CCCOMCOM $ASFLAGS -E -x c $SOURCE', target = target, source = source)
 ld_script_builder = Builder(action = Action(
-    '$CC $_CCCOMCOM $ASFLAGS -E -x c $SOURCE | grep -v "^\#" > $TARGET',
-    '$GENCOMSTR'))
+    ld_script_func, strfunction = ld_script_str,
+    varlist = ['CC', '_CCCOMCOM', 'ASFLAGS']))
 
 # Custom method to build a Kiwi application.
 def kiwi_application_method(env, name, sources, **kwargs):
-    override_flags = kwargs['override_flags'] if 'override_flags' in kwargs else {}
+    override_flags = kwargs.get('override_flags', {})
 
     target = File(name)
 
@@ -37,7 +57,7 @@ def kiwi_application_method(env, name, sources, **kwargs):
 
 # Custom method to build a Kiwi service.
 def kiwi_service_method(env, name, sources, **kwargs):
-    override_flags = kwargs['flags'] if 'flags' in kwargs else {}
+    override_flags = kwargs.get('flags', {})
 
     target = File(name)
 
@@ -52,9 +72,9 @@ def kiwi_service_method(env, name, sources, **kwargs):
 def kiwi_library_method(env, name, sources, **kwargs):
     manager = env['_MANAGER']
 
-    build_libraries = kwargs['build_libraries'] if 'build_libraries' in kwargs else []
-    include_paths = kwargs['include_paths'] if 'include_paths' in kwargs else []
-    override_flags = kwargs['override_flags'] if 'override_flags' in kwargs else {}
+    build_libraries = kwargs.get('build_libraries', [])
+    include_paths = kwargs.get('include_paths', [])
+    override_flags = kwargs.get('override_flags', {})
 
     # Register this library with the build manager.
     manager.AddLibrary(name, build_libraries, include_paths)
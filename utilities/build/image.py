@@ -15,130 +15,465 @@
 #
 
 from SCons.Script import *
-import io, tarfile, glob, os, tempfile, shutil, time
+import os, re, sys, errno, stat, struct, fcntl, subprocess, tempfile, shutil, time, functools
+from collections import deque, Counter
+
+# ioctl to clone a file's data on filesystems that support reflinks.
+FICLONE = 0x40049409
+
+# Create a copy-on-write clone of a file. Raises OSError if not supported.
+def clone_file(src, dest):
+    if not sys.platform.startswith('linux'):
+        raise OSError('File cloning is not supported')
+
+    try:
+        with open(src, 'rb') as infile, open(dest, 'wb') as outfile:
+            fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+    except OSError:
+        os.remove(dest)
+        raise
+    shutil.copystat(src, dest)
+
+# Place a file at a path by hard linking it if possible, to avoid copying the
+# data, and otherwise copying it. Anything already at the destination is
+# replaced. Clones cannot be made across filesystems either, but linking can
+# fail on the same filesystem (e.g. with EPERM due to protected_hardlinks), in
+# which case a clone is tried before copying.
+def link_file(src, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(os.path.realpath(src), dest)
+        return
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            shutil.copy2(src, dest)
+            return
+    try:
+        clone_file(src, dest)
+    except OSError:
+        shutil.copy2(src, dest)
+
+# TAR entry types used in generated archives.
+REGTYPE = b'0'
+SYMTYPE = b'2'
+DIRTYPE = b'5'
+
+# Size used for reading and writing archive data.
+copy_size = 1 << 20
+
+# Whether sendfile() can be used to copy between regular files.
+use_sendfile = sys.platform.startswith('linux') and hasattr(os, 'sendfile')
+
+# Layout of a ustar header block.
+tar_header_struct = struct.Struct('100s8s8s8s12s12s8sc100s6s2s32s32s8s8s155s12x')
+
+# The kernel's extractor only looks at the name field of a header and ignores
+# the prefix field, so names and link targets must fit into the name field.
+def check_tar_name(name, linkname = ''):
+    if len(name.encode('utf-8')) > 99 or len(linkname.encode('utf-8')) > 99:
+        raise Exception("Path '%s' is too long for TAR archive" % (name))
+
+# Build a ustar header block. Long names are not split, see check_tar_name().
+def tar_header(name, type, mode, mtime, size = 0, linkname = ''):
+    check_tar_name(name, linkname)
+    name = name.encode('utf-8')
+    linkname = linkname.encode('utf-8')
+
+    header = tar_header_struct.pack(
+        name, b'%07o' % (mode), b'%07o' % (0), b'%07o' % (0), b'%011o' % (size),
+        b'%011o' % (mtime), b' ' * 8, type, linkname, b'ustar', b'00', b'root',
+        b'root', b'%07o' % (0), b'%07o' % (0), b'')
+
+    # The checksum is calculated with the checksum field set to spaces.
+    return header[:148] + b'%06o\0 ' % (sum(header)) + header[156:]
 
 class TARArchive:
     def __init__(self, path):
-        self.tar = tarfile.open(path, 'w')
+        # Write through a large buffer, headers and padding are small writes.
+        self.path = path
+        self.file = open(path, 'wb', buffering = copy_size)
+
+        # Set of directories that have been added to the archive, to avoid
+        # having to search the member list for each one.
+        self.dirs = set()
+
+        # All generated entries get the same modification time.
+        self.mtime = int(time.time())
 
     def finish(self):
-        self.tar.close()
+        # The end of the archive is marked by two zero blocks. Pad the archive
+        # out to a multiple of the standard record size like tar does.
+        self.file.write(b'\0' * 1024)
+        remainder = self.file.tell() % 10240
+        if remainder:
+            self.file.write(b'\0' * (10240 - remainder))
+        self.file.close()
+
+    # Discard a partially written archive after an error.
+    def abort(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def add_entry(self, name, type, mode, mtime = None, size = 0, linkname = ''):
+        if mtime is None:
+            mtime = self.mtime
+        self.file.write(tar_header(name, type, mode, mtime, size, linkname))
+
+    def add_data(self, data):
+        self.file.write(data)
+        self.pad(len(data))
+
+    # Copy data for an entry from a file. Source files are opened unbuffered
+    # since they are read in large chunks, and the size comes from the stat
+    # information that was already obtained for the header. Where possible the
+    # data is copied within the kernel with sendfile(), falling back to reading
+    # and writing it if that is not supported for the files.
+    def copy_data(self, file, size):
+        offset = 0
+        if use_sendfile:
+            self.file.flush()
+            try:
+                while offset < size:
+                    count = os.sendfile(self.file.fileno(), file.fileno(), offset, size - offset)
+                    if count == 0:
+                        break
+                    offset += count
+            except OSError:
+                pass
+
+            # Resynchronise the buffered file's position with the descriptor.
+            self.file.seek(0, os.SEEK_END)
+
+        file.seek(offset)
+        while offset < size:
+            data = file.read(min(size - offset, copy_size))
+            if not data:
+                raise Exception("File '%s' changed size while being archived" % (file.name))
+            self.file.write(data)
+            offset += len(data)
+        self.pad(size)
+
+    def pad(self, size):
+        remainder = size % 512
+        if remainder:
+            self.file.write(b'\0' * (512 - remainder))
 
     def make_dir(self, name):
-        if len(name) == 0:
-            return
-        try:
-            self.tar.getmember(name)
-        except KeyError:
-            self.make_dir(os.path.dirname(name))
+        # Find the directories on the path that have not yet been added, then
+        # add them working down from the top.
+        missing = []
+        while len(name) != 0 and name not in self.dirs:
+            missing.append(name)
+            name = os.path.dirname(name)
+
+        for name in reversed(missing):
+            self.add_entry(name, DIRTYPE, 0o755)
+            self.dirs.add(name)
+
+    # Add a file with the given contents, which can be either a string to be
+    # encoded as UTF-8 or bytes.
+    def make_file(self, name, data):
+        self.make_dir(os.path.dirname(name))
 
-            tarinfo = tarfile.TarInfo(name)
-            tarinfo.type  = tarfile.DIRTYPE
-            tarinfo.mtime = int(time.time())
-            tarinfo.mode  = 0o755
-            tarinfo.uid   = 0
-            tarinfo.gid   = 0
-            tarinfo.uname = "root"
-            tarinfo.gname = "root"
+        if type(data) == str:
+            data = data.encode('utf-8')
+        self.add_entry(name, REGTYPE, 0o644, size = len(data))
+        self.add_data(data)
 
-            self.tar.addfile(tarinfo)
+    def add_files(self, files):
+        # Small file contents are read on a thread pool so that reads overlap
+        # with writing out the archive. Only this thread touches the archive.
+        # The number of files and amount of data in flight are both bounded to
+        # limit memory usage, but at least one file is always read. Files at
+        # least as large as the copy buffer are not read ahead, their data is
+        # copied straight from the file when they are reached.
+        def read_file(target):
+            with open(target, 'rb', buffering = 0) as file:
+                return file.read()
+
+        # Imported here as this module is loaded on every SCons run, but this
+        # is only needed when an image is actually built.
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers = 8) as pool:
+            pending = deque()
+            pending_size = 0
+            files = iter(files)
+
+            while True:
+                while len(pending) < 32 and pending_size < (64 << 20):
+                    try:
+                        (path, target) = next(files)
+                    except StopIteration:
+                        break
+                    target = str(target)
+                    st = os.stat(target)
+                    if st.st_size < copy_size:
+                        pending.append((path, target, st, pool.submit(read_file, target)))
+                        pending_size += st.st_size
+                    else:
+                        pending.append((path, target, st, None))
+                if len(pending) == 0:
+                    break
+
+                (path, target, st, future) = pending.popleft()
+
+                self.make_dir(os.path.dirname(path))
+
+                mode = stat.S_IMODE(st.st_mode)
+                mtime = int(st.st_mtime)
+
+                if future:
+                    data = future.result()
+                    pending_size -= st.st_size
+
+                    self.add_entry(path, REGTYPE, mode, mtime, len(data))
+                    self.add_data(data)
+                else:
+                    with open(target, 'rb', buffering = 0) as file:
+                        self.add_entry(path, REGTYPE, mode, mtime, st.st_size)
+                        self.copy_data(file, st.st_size)
 
-    def make_file(self, name, data):
-        self.make_dir(os.path.dirname(name))
+    def add_links(self, links):
+        for (path, target) in links:
+            self.make_dir(os.path.dirname(path))
+            self.add_entry(path, SYMTYPE, 0o777, linkname = target)
 
-        file = io.BytesIO(data.encode('utf-8'))
+    def add_dir_tree(self, path):
+        # Skip hidden entries.
+        with os.scandir(path) as entries:
+            for entry in sorted(entries, key = lambda e: e.name):
+                if entry.name[0] != '.':
+                    self.add_tree_entry(entry, entry.name)
+
+    def add_tree_entry(self, entry, name):
+        # Build the header from the directory entry's stat information.
+        st = entry.stat(follow_symlinks = False)
+        mode = stat.S_IMODE(st.st_mode)
+        mtime = int(st.st_mtime)
+
+        if entry.is_symlink():
+            self.add_entry(name, SYMTYPE, mode, linkname = os.readlink(entry.path))
+        elif entry.is_dir(follow_symlinks = False):
+            if name not in self.dirs:
+                self.add_entry(name, DIRTYPE, mode, mtime)
+                self.dirs.add(name)
+
+            with os.scandir(entry.path) as entries:
+                for child in sorted(entries, key = lambda e: e.name):
+                    self.add_tree_entry(child, name + '/' + child.name)
+        elif entry.is_file(follow_symlinks = False):
+            with open(entry.path, 'rb', buffering = 0) as file:
+                self.add_entry(name, REGTYPE, mode, mtime, st.st_size)
+                self.copy_data(file, st.st_size)
+
+# Archive writer which uses GNU tar to do the work. The archive contents are
+# staged in a temporary directory next to the output using hard links where
+# possible, so that no file data is copied before tar reads it. Generated
+# entries are given the same modes as TARArchive gives them, rather than ones
+# depending on the umask.
+class NativeTARArchive:
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.staging = tempfile.mkdtemp('.kiwitar', dir = os.path.dirname(self.path))
 
-        tarinfo = tarfile.TarInfo(name)
-        tarinfo.type     = tarfile.REGTYPE
-        tarinfo.mtime    = int(time.time())
-        tarinfo.mode     = 0o644
-        tarinfo.uid      = 0
-        tarinfo.gid      = 0
-        tarinfo.uname    = "root"
-        tarinfo.gname    = "root"
-        tarinfo.size     = len(data)
+    def finish(self):
+        try:
+            self.check_names()
+            subprocess.check_call(
+                ['tar', '--create', '--file=' + self.path, '--format=ustar',
+                 '--owner=root:0', '--group=root:0', '--hard-dereference',
+                 '--sort=name', '-C', self.staging, '--'] + sorted(os.listdir(self.staging)))
+        finally:
+            shutil.rmtree(self.staging)
+
+    # Discard the staged contents after an error.
+    def abort(self):
+        shutil.rmtree(self.staging, ignore_errors = True)
+
+    # GNU tar splits long names into the prefix field, which the kernel does
+    # not handle, so check the staged names the same way as TARArchive does.
+    # Directory names are stored with a trailing slash.
+    def check_names(self):
+        for (dirpath, dirnames, filenames) in os.walk(self.staging):
+            base = os.path.relpath(dirpath, self.staging)
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                name = os.path.normpath(os.path.join(base, name))
+                if os.path.islink(path):
+                    check_tar_name(name, os.readlink(path))
+                elif os.path.isdir(path):
+                    check_tar_name(name + '/')
+                else:
+                    check_tar_name(name)
+
+    def stage_path(self, name):
+        return os.path.join(self.staging, name)
 
-        self.tar.addfile(tarinfo, file)
+    def make_dir(self, name):
+        # Create the missing directories on the path working down from the
+        # top, setting their modes explicitly.
+        missing = []
+        while len(name) != 0 and not os.path.isdir(self.stage_path(name)):
+            missing.append(name)
+            name = os.path.dirname(name)
+
+        for name in reversed(missing):
+            path = self.stage_path(name)
+            os.mkdir(path)
+            os.chmod(path, 0o755)
+
+    def make_file(self, name, data):
+        self.make_dir(os.path.dirname(name))
+
+        # Staged files may be hard links to build outputs or source files, so
+        # remove anything already at the path rather than writing through it.
+        path = self.stage_path(name)
+        if os.path.lexists(path):
+            os.remove(path)
+        if type(data) == str:
+            data = data.encode('utf-8')
+        with open(path, 'wb') as file:
+            file.write(data)
+        os.chmod(path, 0o644)
 
     def add_files(self, files):
         for (path, target) in files:
-            while path[0] == '/':
-                path = path[1:]
-
             self.make_dir(os.path.dirname(path))
-
-            with open(str(target), 'rb') as file:
-                tarinfo = self.tar.gettarinfo(None, path, file)
-                tarinfo.uid   = 0
-                tarinfo.gid   = 0
-                tarinfo.uname = "root"
-                tarinfo.gname = "root"
-
-                self.tar.addfile(tarinfo, file)
+            link_file(str(target), self.stage_path(path))
 
     def add_links(self, links):
         for (path, target) in links:
-            while path[0] == '/':
-                path = path[1:]
-
             self.make_dir(os.path.dirname(path))
-
-            tarinfo = tarfile.TarInfo(path)
-            tarinfo.type     = tarfile.SYMTYPE
-            tarinfo.linkname = target
-            tarinfo.mtime    = int(time.time())
-            tarinfo.mode     = 0o644
-            tarinfo.uid      = 0
-            tarinfo.gid      = 0
-            tarinfo.uname    = "root"
-            tarinfo.gname    = "root"
-
-            self.tar.addfile(tarinfo)
+            path = self.stage_path(path)
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(target, path)
 
     def add_dir_tree(self, path):
-        for f in glob.glob(os.path.join(path, '*')):
-            self.tar.add(f, arcname = os.path.relpath(f, path))
+        # Skip hidden entries.
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name[0] == '.':
+                    continue
+                dest = self.stage_path(entry.name)
+                if entry.is_dir(follow_symlinks = False):
+                    shutil.copytree(entry.path, dest, symlinks = True,
+                        copy_function = link_file, dirs_exist_ok = True)
+                elif entry.is_symlink():
+                    if os.path.lexists(dest):
+                        os.remove(dest)
+                    os.symlink(os.readlink(entry.path), dest)
+                else:
+                    link_file(entry.path, dest)
+
+# Check whether GNU tar is available to build archives with. Version 1.28 is
+# needed for --sort.
+@functools.lru_cache(maxsize = None)
+def have_gnu_tar():
+    try:
+        output = subprocess.run(['tar', '--version'], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL).stdout
+    except OSError:
+        return False
+    match = re.search(br'\(GNU tar\) (\d+)\.(\d+)', output)
+    return match is not None and (int(match.group(1)), int(match.group(2))) >= (1, 28)
+
+# Create an archive writer, using native tar if possible.
+def create_archive(path):
+    return NativeTARArchive(path) if have_gnu_tar() else TARArchive(path)
+
+# Calculate a digest of a file's contents.
+def file_digest(path):
+    import hashlib
+    digest = hashlib.blake2b(digest_size = 16)
+    with open(path, 'rb', buffering = 0) as file:
+        while True:
+            data = file.read(copy_size)
+            if not data:
+                break
+            digest.update(data)
+    return digest.digest()
+
+# Replace files which have the same contents and mode as an earlier file in the
+# list with relative symbolic links to that file. Returns a tuple of the files
+# still to be added and the links to add in place of the others. Only files
+# which share their size and mode with another file need to be read.
+def dedup_files(files):
+    stats = [os.stat(str(target)) for (path, target) in files]
+    counts = Counter((st.st_size, st.st_mode) for st in stats)
+
+    first = {}
+    unique = []
+    links = []
+    for ((path, target), st) in zip(files, stats):
+        key = (st.st_size, st.st_mode)
+        if st.st_size > 0 and counts[key] > 1:
+            key += (file_digest(str(target)),)
+            if key in first:
+                links.append((path, os.path.relpath(first[key], os.path.dirname(path))))
+                continue
+            first[key] = path
+        unique.append((path, target))
+
+    return (unique, links)
 
 # Create a TAR archive containing the filesystem tree.
 def fs_image_func(target, source, env):
     config = env['_CONFIG']
 
-    tar = TARArchive(str(target[0]))
-
-    tar.add_files(env['FILES'])
-    tar.add_links(env['LINKS'])
-    tar.add_dir_tree(str(Dir('#/data')))
-
-    # Add in extra stuff from the directory specified in the configuration.
-    if len(config['EXTRA_FSIMAGE']) > 0:
-        tar.add_dir_tree(config['EXTRA_FSIMAGE'])
+    tar = create_archive(str(target[0]))
+    try:
+        # Add entries in path order, so that entries in the same directory are
+        # grouped together and the archive layout does not depend on the order
+        # in which the SConscripts registered them.
+        files = sorted(env['FILES'].items())
+        links = sorted(env['LINKS'].items())
+        if config['FSIMAGE_DEDUP']:
+            (files, dups) = dedup_files(files)
+            links = sorted(links + dups)
+
+        tar.add_files(files)
+        tar.add_links(links)
+        tar.add_dir_tree(str(Dir('#/data')))
+
+        # Add in extra stuff from the directory specified in the configuration.
+        extra = config['EXTRA_FSIMAGE']
+        if len(extra) > 0:
+            tar.add_dir_tree(extra)
+    except:
+        tar.abort()
+        raise
 
     tar.finish()
     return 0
 def fs_image_emitter(target, source, env):
     # We must depend on every file that goes into the image.
-    deps = [f for (p, f) in env['FILES']]
+    deps = list(env['FILES'].values())
     return (target, source + deps)
 fs_image_builder = Builder(action = Action(fs_image_func, '$GENCOMSTR'), emitter = fs_image_emitter)
 
 # Create a boot image.
 def boot_image_func(target, source, env):
-    config = env['_CONFIG']
-
-    tar = TARArchive(str(target[0]))
+    tar = create_archive(str(target[0]))
+    try:
+        files = [
+            ('kernel', env['KERNEL']),
+            ('modules/fsimage.tar', env['FSIMAGE']),
+        ]
 
-    files = [
-        ('kernel', env['KERNEL']),
-        ('modules/fsimage.tar', env['FSIMAGE']),
-    ]
+        for mod in env['MODULES']:
+            files += [('modules/' + os.path.basename(str(mod)), mod)]
 
-    for mod in env['MODULES']:
-        files += [('modules/' + os.path.basename(str(mod)), mod)]
+        tar.add_files(files)
 
-    tar.add_files(files)
-
-    kboot_cfg = 'kboot "/kernel" "/modules"\n'
-    tar.make_file('kboot.cfg', kboot_cfg)
+        kboot_cfg = 'kboot "/kernel" "/modules"\n'
+        tar.make_file('kboot.cfg', kboot_cfg)
+    except:
+        tar.abort()
+        raise
 
     tar.finish()
     return 0
@@ -153,35 +488,40 @@ def iso_image_func(target, source, env):
     fsimage = str(env['FSIMAGE'])
     kernel = str(env['KERNEL'])
 
-    # Create the work directory.
-    tmpdir = tempfile.mkdtemp('.kiwiiso')
-    os.makedirs(os.path.join(tmpdir, 'boot'))
-    os.makedirs(os.path.join(tmpdir, 'kiwi', 'modules'))
-
-    # Copy stuff into it.
-    shutil.copy(kernel, os.path.join(tmpdir, 'kiwi'))
-    shutil.copy(fsimage, os.path.join(tmpdir, 'kiwi', 'modules'))
-    for mod in env['MODULES']:
-        shutil.copy(str(mod), os.path.join(tmpdir, 'kiwi', 'modules'))
-
-    # Write the configuration.
-    f = open(os.path.join(tmpdir, 'boot', 'kboot.cfg'), 'w')
-    f.write('set "timeout" 5\n')
-    f.write('entry "Kiwi" {\n')
-    if len(config['FORCE_VIDEO_MODE']) > 0:
-        f.write('   set "video_mode" "%s"\n' % (config['FORCE_VIDEO_MODE']))
-    f.write('   kboot "/kiwi/kernel" "/kiwi/modules"\n')
-    f.write('}\n')
-    f.close()
-
-    # Create the ISO.
-    verbose = '' if (ARGUMENTS.get('V') == '1') else '>> /dev/null 2>&1'
-    config = env['_CONFIG']
-    ret = os.system(
-        '%s --bin-dir=build/%s-%s/boot/bin --targets="%s" --label="Kiwi CDROM" %s %s %s' %
-            (env['KBOOT_MKISO'], config['ARCH'], config['BUILD'], config['KBOOT_TARGETS'], target[0], tmpdir, verbose))
+    # Create the work directory. This is placed alongside the output so that
+    # it is on the same filesystem as the build tree and files can be linked.
+    tmpdir = tempfile.mkdtemp('.kiwiiso', dir = os.path.dirname(os.path.abspath(str(target[0]))))
+    try:
+        os.makedirs(os.path.join(tmpdir, 'boot'))
+        os.makedirs(os.path.join(tmpdir, 'kiwi', 'modules'))
+
+        # Link stuff into it.
+        link_file(kernel, os.path.join(tmpdir, 'kiwi', os.path.basename(kernel)))
+        link_file(fsimage, os.path.join(tmpdir, 'kiwi', 'modules', os.path.basename(fsimage)))
+        for mod in env['MODULES']:
+            link_file(str(mod), os.path.join(tmpdir, 'kiwi', 'modules', os.path.basename(str(mod))))
+
+        # Write the configuration.
+        lines = ['set "timeout" 5\n', 'entry "Kiwi" {\n']
+        video_mode = config['FORCE_VIDEO_MODE']
+        if len(video_mode) > 0:
+            lines.append('   set "video_mode" "%s"\n' % (video_mode))
+        lines += ['   kboot "/kiwi/kernel" "/kiwi/modules"\n', '}\n']
+        with open(os.path.join(tmpdir, 'boot', 'kboot.cfg'), 'w') as f:
+            f.write(''.join(lines))
+
+        # Create the ISO.
+        output = None if (ARGUMENTS.get('V') == '1') else subprocess.DEVNULL
+        ret = subprocess.call([
+                str(env['KBOOT_MKISO']),
+                '--bin-dir=build/%s-%s/boot/bin' % (config['ARCH'], config['BUILD']),
+                '--targets=%s' % (config['KBOOT_TARGETS']),
+                '--label=Kiwi CDROM',
+                str(target[0]), tmpdir
+            ], stdout = output, stderr = output)
+    finally:
+        shutil.rmtree(tmpdir)
 
-    shutil.rmtree(tmpdir)
     return ret
 def iso_image_emitter(target, source, env):
     return (target, [env['KERNEL']] + env['MODULES'] + env['KBOOT'] + [env['FSIMAGE']] + [env['KBOOT_MKISO']])
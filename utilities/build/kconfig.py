@@ -14,6 +14,17 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
+import re
+
+# Regular expression matching a configuration value line. The value groups are,
+# in order: a string, a hexadecimal integer, a decimal integer and a boolean.
+config_value_re = re.compile(
+    r'^[ \t]*CONFIG_(\w+)[ \t]*=[ \t]*(?:"(.*)"|0x([0-9a-fA-F]+)|([0-9]+)|(y))[ \t\r]*$',
+    re.M)
+
+# Regular expression matching any line that is not blank or a comment.
+config_content_re = re.compile(r'^[ \t]*[^#\s]', re.M)
+
 # Class to parse a Kconfig configuration file.
 class ConfigParser(dict):
     def __init__(self, path):
@@ -30,53 +41,35 @@ class ConfigParser(dict):
         # Read and parse the file contents. We return without adding
         # any values if there is a parse error, this will cause
         # configured() to return false and require the user to reconfig.
-        lines = f.readlines()
-        f.close()
+        with f:
+            data = f.read()
         values = {}
-        for line in lines:
-            line = line.strip()
-
-            # Ignore blank lines or comments.
-            if not len(line) or line[0] == '#':
-                continue
-
-            # Split the line into key/value.
-            line = line.split('=', 1)
-            if len(line) != 2:
-                return
-            key = line[0].strip()
-            value = line[1].strip()
-            if len(key) < 8 or key[0:7] != 'CONFIG_' or not len(value):
-                return
-            key = line[0].strip()[7:]
-
-            # Work out the correct value.
-            if value == 'y':
+        count = 0
+        for match in config_value_re.finditer(data):
+            (key, string, hexadecimal, decimal, boolean) = match.groups()
+            if boolean is not None:
                 value = True
-            elif value[0] == '"' and value[-1] == '"':
-                value = value[1:-1]
-            elif value[0:2] == '0x' and len(value) > 2:
-                value = int(value, 16)
-            elif value.isdigit():
-                value = int(value)
+            elif string is not None:
+                value = string
+            elif hexadecimal is not None:
+                value = int(hexadecimal, 16)
             else:
-                print("Unrecognised value type: %s" % (value))
-                return
-
-            # Add it to the dictionary.
+                value = int(decimal)
             values[key] = value
+            count += 1
+
+        # Every line other than blank lines and comments must have been
+        # matched as a value.
+        if len(config_content_re.findall(data)) != count:
+            print("Unrecognised line in configuration file %s" % (path))
+            return
 
         # Everything was OK, add stuff into the real dictionary.
-        for (k, v) in values.items():
-            self[k] = v
+        self.update(values)
 
-    # Get a configuration value. This returns None for any accesses to
-    # undefined keys.
-    def __getitem__(self, key):
-        try:
-            return dict.__getitem__(self, key)
-        except KeyError:
-            return None
+    # Return None for any accesses to undefined keys.
+    def __missing__(self, key):
+        return None
 
     # Check whether the build configuration exists.
     def configured(self):
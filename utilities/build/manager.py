@@ -15,14 +15,21 @@
 #
 
 from SCons.Script import *
+import SCons.Builder, SCons.Errors, SCons.Tool
 import builders, image
+from util import CompilerIncludeDir
+
+# Prefix of the short build output lines.
+compile_str_prefix = '\033[0;32m%8s\033[0m'
 
 class BuildManager:
     def __init__(self, host_template, target_template):
         self.envs = []
+        self.named_envs = {}
         self.host_template = host_template
         self.target_template = target_template
         self.libraries = {}
+        self.target_base_flags = None
 
         # Add a reference to ourself to all environments.
         self.AddVariable('_MANAGER', self)
@@ -30,45 +37,77 @@ class BuildManager:
         # Create compile strings that will be added to all environments.
         verbose = ARGUMENTS.get('V') == '1'
         def compile_str(msg):
-            return None if verbose else '\033[0;32m%8s\033[0m $TARGET' % (msg)
-        def compile_str_func(msg, target, source, env):
-            return '\033[0;32m%8s\033[0m %s' % (msg, str(target[0]))
-
-        self.AddVariable('ARCOMSTR',             compile_str('AR'))
-        self.AddVariable('ASCOMSTR',             compile_str('ASM'))
-        self.AddVariable('ASPPCOMSTR',           compile_str('ASM'))
-        self.AddVariable('CCCOMSTR',             compile_str('CC'))
-        self.AddVariable('SHCCCOMSTR',           compile_str('CC'))
-        self.AddVariable('CXXCOMSTR',            compile_str('CXX'))
-        self.AddVariable('SHCXXCOMSTR',          compile_str('CXX'))
-        self.AddVariable('YACCCOMSTR',           compile_str('YACC'))
-        self.AddVariable('LEXCOMSTR',            compile_str('LEX'))
-        self.AddVariable('LINKCOMSTR',           compile_str('LINK'))
-        self.AddVariable('SHLINKCOMSTR',         compile_str('SHLINK'))
-        self.AddVariable('RANLIBCOMSTR',         compile_str('RANLIB'))
-        self.AddVariable('GENCOMSTR',            compile_str('GEN'))
-        self.AddVariable('STRIPCOMSTR',          compile_str('STRIP'))
-        self.AddVariable('COMPILATIONDB_COMSTR', compile_str('DB'))
+            return None if verbose else (compile_str_prefix % (msg)) + ' $TARGET'
+
+        # No environments exist yet, so these only need to be set on the
+        # templates.
+        comstrs = {
+            'ARCOMSTR':             compile_str('AR'),
+            'ASCOMSTR':             compile_str('ASM'),
+            'ASPPCOMSTR':           compile_str('ASM'),
+            'CCCOMSTR':             compile_str('CC'),
+            'SHCCCOMSTR':           compile_str('CC'),
+            'CXXCOMSTR':            compile_str('CXX'),
+            'SHCXXCOMSTR':          compile_str('CXX'),
+            'YACCCOMSTR':           compile_str('YACC'),
+            'LEXCOMSTR':            compile_str('LEX'),
+            'LINKCOMSTR':           compile_str('LINK'),
+            'SHLINKCOMSTR':         compile_str('SHLINK'),
+            'RANLIBCOMSTR':         compile_str('RANLIB'),
+            'GENCOMSTR':            compile_str('GEN'),
+            'STRIPCOMSTR':          compile_str('STRIP'),
+            'COMPILATIONDB_COMSTR': compile_str('DB'),
+        }
+        self.host_template.Replace(**comstrs)
+        self.target_template.Replace(**comstrs)
 
         if not verbose:
             # Substfile doesn't provide a method to override the output. Hack around.
-            func = lambda t, s, e: compile_str_func('GEN', t, s, e)
+            prefix = compile_str_prefix % ('GEN')
+            func = lambda t, s, e: '%s %s' % (prefix, str(t[0]))
             self.host_template['BUILDERS']['Substfile'].action.strfunction = func
             self.target_template['BUILDERS']['Substfile'].action.strfunction = func
 
+        # The configuration header is only used through -include, so the
+        # scanner does not find it and its contents are not part of the
+        # signature of objects built with it. Since the header is generated
+        # from the configuration, make such objects depend on the
+        # configuration values instead.
+        def config_header_emitter(target, source, env):
+            config = env['_CONFIG']
+            header = 'build/%s-%s/config.h' % (config['ARCH'], config['BUILD'])
+            if header in env['CCFLAGS'] or header in env['ASFLAGS']:
+                if self.config_value is None:
+                    self.config_value = Value(repr(list(config.items())))
+                Depends(target, self.config_value)
+            return (target, source)
+        self.config_value = None
+        for builder in SCons.Tool.createObjBuilders(self.target_template):
+            for (suffix, emitter) in list(builder.emitter.items()):
+                builder.emitter[suffix] = SCons.Builder.ListEmitter([emitter, config_header_emitter])
+
         # Add builders from builders.py
         self.AddBuilder('LDScript', builders.ld_script_builder)
 
         # Create the distribution environment and various methods to add data
         # to an image.
         dist = self.CreateBare(name = 'dist', flags = {
-            'FILES': [],
-            'LINKS': [],
+            'FILES': {},
+            'LINKS': {},
         })
+        # Files and links are stored in dictionaries indexed by path, relative
+        # to the image root so that image builders can use them as archive
+        # names directly. The kernel will not extract two entries at the same
+        # path, so it is an error to add a path again with a different target.
+        def add_image_entry(env, key, target, path):
+            path = path.lstrip('/')
+            other = 'LINKS' if key == 'FILES' else 'FILES'
+            if path in env[other] or str(env[key].setdefault(path, target)) != str(target):
+                raise SCons.Errors.StopError("Path '%s' is added to the image with different targets" % (path))
         def add_file_method(env, target, path):
-            env['FILES'].append((path, target))
+            add_image_entry(env, 'FILES', target, path)
         def add_link_method(env, target, path):
-            env['LINKS'].append((path, target))
+            add_image_entry(env, 'LINKS', target, path)
         dist.AddMethod(add_file_method, 'AddFile')
         dist.AddMethod(add_link_method, 'AddLink')
 
@@ -80,11 +119,7 @@ class BuildManager:
     def __getitem__(self, key):
         """Get an environment by name."""
 
-        for (k, v) in self.envs:
-            if k and k == key:
-                return v
-
-        return None
+        return self.named_envs.get(key)
 
     def AddVariable(self, name, value):
         """Add a variable to all environments and all future environments."""
@@ -92,8 +127,8 @@ class BuildManager:
         self.host_template[name] = value
         self.target_template[name] = value
 
-        for (k, v) in self.envs:
-            v[name] = value
+        for env in self.envs:
+            env[name] = value
 
     def AddBuilder(self, name, builder):
         """Add a builder to all environments and all future environments."""
@@ -101,13 +136,13 @@ class BuildManager:
         self.host_template['BUILDERS'][name] = builder
         self.target_template['BUILDERS'][name] = builder
 
-        for (k, v) in self.envs:
-            v['BUILDERS'][name] = builder
+        for env in self.envs:
+            env['BUILDERS'][name] = builder
 
     def AddTool(self, name, depends, act):
         """Add a build tool to all environments and all future environments."""
 
-        if type(depends) != list:
+        if not isinstance(depends, list):
             depends = [depends]
         def dep_emitter(target, source, env):
             for dep in depends:
@@ -116,57 +151,60 @@ class BuildManager:
         self.AddBuilder(name, Builder(action = act, emitter = dep_emitter))
 
     def AddLibrary(self, name, build_libraries, include_paths):
+        # Include paths can be a (directory, sysroot location) tuple. Work out
+        # the plain directory list for CPPPATH here once rather than for every
+        # environment which uses the library.
         self.libraries[name] = {
             'build_libraries': build_libraries,
             'include_paths': include_paths,
+            'include_dirs': [d[0] if isinstance(d, tuple) else d for d in include_paths],
         }
 
     def CreateHost(self, **kwargs):
         """Create an environment for building for the host system."""
 
-        name = kwargs['name'] if 'name' in kwargs else None
-        flags = kwargs['flags'] if 'flags' in kwargs else {}
+        name = kwargs.get('name')
+        flags = kwargs.get('flags', {})
 
         env = self.host_template.Clone()
         self.merge_flags(env, flags)
-        self.envs.append((name, env))
+        self.add_env(name, env)
         return env
 
     def CreateBare(self, **kwargs):
         """Create an environment for building for the target system."""
 
-        name = kwargs['name'] if 'name' in kwargs else None
-        flags = kwargs['flags'] if 'flags' in kwargs else {}
+        name = kwargs.get('name')
+        flags = kwargs.get('flags', {})
 
         env = self.target_template.Clone()
         self.merge_flags(env, flags)
-        self.envs.append((name, env))
+        self.add_env(name, env)
         return env
 
     def Create(self, **kwargs):
         """Create an environment for building for the target system."""
 
-        name = kwargs['name'] if 'name' in kwargs else None
-        flags = kwargs['flags'] if 'flags' in kwargs else {}
-        libraries = kwargs['libraries'] if 'libraries' in kwargs else []
+        name = kwargs.get('name')
+        flags = kwargs.get('flags', {})
+        libraries = kwargs.get('libraries', [])
 
         env = self.target_template.Clone()
-        config = env['_CONFIG']
-
-        # Get the compiler include directory which contains some standard
-        # headers.
-        from subprocess import Popen, PIPE
-        incdir = Popen([env['CC'], '-print-file-name=include'], stdout = PIPE).communicate()[0].strip().decode('utf-8')
 
         # Specify -nostdinc to prevent the compiler from using the automatically
         # generated sysroot. That only needs to be used when compiling outside
         # the build system, we manage all the header paths internally. We do
         # need to add the compiler's own include directory to the path, though.
+        # These flags are the same for every environment so are only worked out
+        # for the first one.
+        if self.target_base_flags is None:
+            config = env['_CONFIG']
+            self.target_base_flags = (
+                '-nostdinc', '-isystem', CompilerIncludeDir(env['CC']), '-include',
+                'build/%s-%s/config.h' % (config['ARCH'], config['BUILD']))
         self.merge_flags(env, {
-            'ASFLAGS': ['-nostdinc', '-isystem', incdir, '-include',
-                'build/%s-%s/config.h' % (config['ARCH'], config['BUILD'])],
-            'CCFLAGS': ['-nostdinc', '-isystem', incdir, '-include',
-                'build/%s-%s/config.h' % (config['ARCH'], config['BUILD'])],
+            'ASFLAGS': list(self.target_base_flags),
+            'CCFLAGS': list(self.target_base_flags),
             'LIBPATH': [env['_LIBOUTDIR']],
             'LIBS': libraries,
         })
@@ -174,34 +212,42 @@ class BuildManager:
         # Add in specified flags.
         self.merge_flags(env, flags)
 
-        # Add paths for dependencies.
-        def add_library(lib):
-            if lib in self.libraries:
-                paths = [d[0] if type(d) == tuple else d for d in self.libraries[lib]['include_paths']]
-                self.merge_flags(env, {'CPPPATH': paths})
-                for dep in self.libraries[lib]['build_libraries']:
-                    add_library(dep)
-        for lib in libraries:
-            add_library(lib)
-
-        # Add paths for default libraries. Technically we shouldn't add libc++
+        # Add paths for the libraries used and everything they depend on. Add
+        # paths for default libraries too. Technically we shouldn't add libc++
         # here if what we're building isn't C++, but we don't know that here,
-        # so just add it - it's not a big deal.
+        # so just add it - it's not a big deal. Each library is visited once,
+        # in depth-first order, even if it is depended on more than once.
+        roots = list(libraries)
         if not 'CCFLAGS' in flags or '-nostdinc' not in flags['CCFLAGS']:
-            add_library('c++')
-            add_library('m')
-            add_library('system')
+            roots += ['c++', 'm', 'system']
+        include_dirs = []
+        visited = set()
+        stack = list(reversed(roots))
+        while len(stack) > 0:
+            lib = stack.pop()
+            if lib in visited or lib not in self.libraries:
+                continue
+            visited.add(lib)
+            include_dirs += self.libraries[lib]['include_dirs']
+            stack += reversed(self.libraries[lib]['build_libraries'])
+        self.merge_flags(env, {'CPPPATH': list(dict.fromkeys(include_dirs))})
 
         # Set up emitters to set dependencies on default libraries.
         def add_library_deps(target, source, env):
-            if not '-nostdlib' in env['LINKFLAGS']:
-                Depends(target[0], env['_LIBOUTDIR'].File('libclang_rt.builtins-%s.a' % (env['_CONFIG']['TOOLCHAIN_ARCH'])))
-            if not ('-nostdlib' in env['LINKFLAGS'] or '-nostartfiles' in env['LINKFLAGS']):
-                Depends(target[0], env['_LIBOUTDIR'].glob('*crt*.o'))
-            if not ('-nostdlib' in env['LINKFLAGS'] or '-nodefaultlibs' in env['LINKFLAGS']):
-                Depends(target[0], env['_LIBOUTDIR'].File('libsystem.so'))
+            linkflags = env['LINKFLAGS']
+            outdir = env['_LIBOUTDIR']
+            nostdlib = '-nostdlib' in linkflags
+            if not nostdlib:
+                Depends(target[0], outdir.File('libclang_rt.builtins-%s.a' % (env['_CONFIG']['TOOLCHAIN_ARCH'])))
+            if not (nostdlib or '-nostartfiles' in linkflags):
+                Depends(target[0], outdir.glob('*crt*.o'))
+            if not (nostdlib or '-nodefaultlibs' in linkflags):
+                Depends(target[0], outdir.File('libsystem.so'))
+
+                # Only check the linker when it matters, this looks at the
+                # suffix of every source.
                 if env['SMARTLINK'](source, target, env, None) == '$CXX':
-                    Depends(target[0], env['_LIBOUTDIR'].File('libc++.so'))
+                    Depends(target[0], outdir.File('libc++.so'))
             return target, source
         env.Append(SHLIBEMITTER = [add_library_deps])
         env.Append(PROGEMITTER = [add_library_deps])
@@ -211,31 +257,44 @@ class BuildManager:
         env.AddMethod(builders.kiwi_library_method, 'KiwiLibrary')
         env.AddMethod(builders.kiwi_service_method, 'KiwiService')
 
-        self.envs.append((name, env))
+        self.add_env(name, env)
         return env
 
     def Clone(self, base, **kwargs):
         """Create a new environment based on an existing named environment."""
 
-        name = kwargs['name'] if 'name' in kwargs else None
-        flags = kwargs['flags'] if 'flags' in kwargs else {}
+        name = kwargs.get('name')
+        flags = kwargs.get('flags', {})
 
         env = base.Clone()
         self.merge_flags(env, flags)
-        self.envs.append((name, env))
+        self.add_env(name, env)
         return env
 
+    def add_env(self, name, env):
+        # If a name is reused, lookups return the first environment created
+        # with it.
+        self.envs.append(env)
+        if name:
+            self.named_envs.setdefault(name, env)
+
     def merge_flags(self, env, flags):
+        # Most calls only give lists for variables that already exist, which
+        # can be passed straight to MergeFlags.
+        if all(isinstance(v, list) and k in env for (k, v) in flags.items()):
+            env.MergeFlags(flags)
+            return
+
         # The MergeFlags function in Environment only handles lists. Add
         # anything else manually.
         merge = {}
         for (k, v) in flags.items():
-            if type(v) == list:
+            if isinstance(v, list):
                 if k in env:
                     merge[k] = v
                 else:
                     env[k] = v
-            elif type(v) == dict and k in env and type(env[k]) == dict:
+            elif isinstance(v, dict) and k in env and isinstance(env[k], dict):
                 env[k].update(v)
             else:
                 env[k] = v
@@ -14,8 +14,7 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 #
 
-import os, sys, shutil
-from subprocess import Popen, PIPE
+import os, sys, shutil, subprocess
 from time import time
 from urllib.parse import urlparse
 
@@ -54,6 +53,31 @@ def remove(path):
     else:
         raise Exception('Unhandled type during remove (%s)' % (path))
 
+# Create a symbolic link, replacing anything already at the path unless it is
+# already a link to the right target.
+def symlink(target, path):
+    try:
+        if os.readlink(path) == target:
+            return
+    except OSError:
+        pass
+
+    remove(path)
+    os.symlink(target, path)
+
+# Write a file, leaving it untouched if it already has the given contents so
+# that its modification time only changes when it actually changes.
+def write_file(path, contents):
+    try:
+        with open(path, 'r') as f:
+            if f.read() == contents:
+                return
+    except IOError:
+        pass
+
+    with open(path, 'w') as f:
+        f.write(contents)
+
 def makedirs(path):
     try:
         os.makedirs(path)
@@ -79,43 +103,48 @@ class ToolchainComponent:
                 return True
         return False
 
+    # Download a source file if it has not already been downloaded. This can
+    # be run for multiple files concurrently.
+    def fetch(self, url):
+        name = urlparse(url).path.split('/')[-1]
+        target = os.path.join(self.manager.destdir, name)
+        if not os.path.exists(target):
+            msg(' Downloading source file: %s' % (name))
+
+            # Download to .part and then rename when complete so we can
+            # easily do continuing of downloads.
+            self.execute(['wget', '-c', '-O', target + '.part', url])
+            os.rename(target + '.part', target)
+
+        return (name, target)
+
     # Download an unpack all sources for the component.
     def download(self):
         for url in self.source:
-            name = urlparse(url).path.split('/')[-1]
-            target = os.path.join(self.manager.destdir, name)
-            if not os.path.exists(target):
-                msg(' Downloading source file: %s' % (name))
-
-                # Download to .part and then rename when complete so we can
-                # easily do continuing of downloads.
-                self.execute('wget -c -O %s %s' % (target + '.part', url))
-                os.rename(target + '.part', target)
+            (name, target) = self.fetch(url)
 
             # Unpack if this is a tarball.
             if name[-8:] == '.tar.bz2':
-                self.execute('tar -C %s -xjf %s' % (self.manager.builddir, target))
+                self.execute(['tar', '-C', self.manager.builddir, '-xjf', target])
             elif name[-7:] == '.tar.gz':
-                self.execute('tar -C %s -xzf %s' % (self.manager.builddir, target))
+                self.execute(['tar', '-C', self.manager.builddir, '-xzf', target])
             elif name[-7:] == '.tar.xz':
-                self.execute('tar -C %s -xJf %s' % (self.manager.builddir, target))
+                self.execute(['tar', '-C', self.manager.builddir, '-xJf', target])
 
     # Helper function to execute a command and throw an exception if required
-    # status not returned.
+    # status not returned. The command can either be an argument list, which
+    # is run directly, or a string, which is run through the shell.
     def execute(self, cmd, directory = '.', expected = 0):
-        print("+ %s" % (cmd))
-        oldcwd = os.getcwd()
-        os.chdir(directory)
-        if os.system(cmd) != expected:
-            os.chdir(oldcwd)
+        shell = type(cmd) != list
+        print("+ %s" % (cmd if shell else ' '.join(cmd)))
+        if subprocess.call(cmd, shell = shell, cwd = directory) != expected:
             raise Exception('Command did not return expected value')
-        os.chdir(oldcwd)
 
     # Apply all patches for this component.
     def patch(self):
         for (p, d, s) in self.patches:
             name = os.path.join(self.manager.srcdir, p)
-            self.execute('patch -Np%d -i %s' % (s, name), d)
+            self.execute(['patch', '-Np%d' % (s), '-i', name], d)
 
     # Performs all required tasks to update this component.
     def _build(self):
@@ -161,8 +190,8 @@ class BinutilsComponent(ToolchainComponent):
         # Build and install it.
         os.mkdir('binutils-build')
         self.execute('../binutils-%s/configure %s' % (self.version, confopts), 'binutils-build')
-        self.execute('make -j%d' % (self.manager.makejobs), 'binutils-build')
-        self.execute('make install', 'binutils-build')
+        self.execute(['make', '-j%d' % (self.manager.makejobs)], 'binutils-build')
+        self.execute(['make', 'install'], 'binutils-build')
 
 # Component definition for LLVM/Clang.
 class LLVMComponent(ToolchainComponent):
@@ -192,8 +221,8 @@ class LLVMComponent(ToolchainComponent):
         # Build and install it.
         os.mkdir('llvm-build')
         self.execute('cmake %s ../llvm-%s.src' % (cmakeopts, self.version), 'llvm-build')
-        self.execute('make -j%d' % (self.manager.makejobs), 'llvm-build')
-        self.execute('make install', 'llvm-build')
+        self.execute(['make', '-j%d' % (self.manager.makejobs)], 'llvm-build')
+        self.execute(['make', 'install'], 'llvm-build')
 
 # Base class for a toolchain.
 class Toolchain:
@@ -219,10 +248,9 @@ class LLVMToolchain(Toolchain):
         for name in ['clang', 'clang++']:
             path = os.path.join(manager.genericdir, 'bin', name)
             wrapper = os.path.join(manager.targetdir, 'bin', '%s-%s' % (manager.target, name))
-            f = open(wrapper, 'w')
-            f.write('#!/bin/bash\n\n')
-            f.write('exec -a "$0" "%s" --sysroot="%s/sysroot" "$@"\n' % (path, manager.targetdir))
-            f.close()
+            write_file(wrapper,
+                '#!/bin/bash\n\nexec -a "$0" "%s" --sysroot="%s/sysroot" "$@"\n' % (
+                    path, manager.targetdir))
             os.chmod(wrapper, 0o755)
         try:
             os.symlink('%s-clang' % (manager.target),
@@ -299,8 +327,7 @@ class ToolchainManager:
         makedirs(runtime_dir)
         runtime_name = 'libclang_rt.builtins-%s.a' % (self.toolchain_arch)
         runtime_lib = os.path.join(runtime_dir, runtime_name)
-        remove(runtime_lib)
-        os.symlink(os.path.join(builddir, 'lib', runtime_name), runtime_lib)
+        symlink(os.path.join(builddir, 'lib', runtime_name), runtime_lib)
 
     # Build a component.
     def build_component(self, c):
@@ -343,11 +370,18 @@ class ToolchainManager:
 
         self.toolchain.pre_update(self)
 
-        # Build necessary components.
+        # Build necessary components. Sources for all of them are downloaded
+        # up front in parallel, the builds themselves happen one at a time.
         try:
-            for c in self.toolchain.components:
-                if c.check():
-                    self.build_component(c)
+            components = [c for c in self.toolchain.components if c.check()]
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor() as pool:
+                futures = [pool.submit(c.fetch, url) for c in components for url in c.source]
+                for future in futures:
+                    future.result()
+
+            for c in components:
+                self.build_component(c)
         except Exception as e:
             msg('Exception during toolchain build: \033[0;0m%s' % (str(e)))
             return 1
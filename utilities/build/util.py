@@ -16,7 +16,8 @@
 
 import SCons.Defaults
 from SCons.Script import *
-from functools import reduce
+from functools import reduce, lru_cache
+import subprocess
 
 # Helpers for creating source lists with certain files only enabled by config
 # settings.
@@ -39,6 +40,13 @@ def FeatureDirs(config, dirs):
             output.append(Dir(f))
     return output
 
+# Get the compiler include directory which contains some standard headers. This
+# is cached since the same compiler is used by many environments.
+@lru_cache(maxsize = None)
+def CompilerIncludeDir(cc):
+    output = subprocess.run([cc, '-print-file-name=include'], stdout = subprocess.PIPE).stdout
+    return output.strip().decode('utf-8')
+
 # Raise an error if a certain target is not specified.
 def RequireTarget(target, error):
     if GetOption('help') or target in COMMAND_LINE_TARGETS: